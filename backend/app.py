@@ -1,69 +1,353 @@
-from flask import Flask, request, jsonify, send_file, send_from_directory, render_template, Response
+from flask import Flask, Blueprint, Request, current_app, request, jsonify, send_from_directory, stream_template, Response
 import os
-from datetime import datetime
+from datetime import datetime, date
+from typing import Literal
 import base64
 import json
+import hashlib
+import threading
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from functools import cached_property
 
-from .processing import process_ndvi, calculate_polygon_area_sqkm
+from .processing import process_ndvi, calculate_polygon_area_sqkm, bbox_area_upper_bound_sqkm, render_graph_png, atomic_output_path
 import logging
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
+import orjson
+from pydantic import BaseModel, Field, ValidationError
+from werkzeug.exceptions import NotFound
 
 # Basic logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
 
-# Flask application configuration
-# Tell Flask where to find the templates folder
-app = Flask(__name__, static_folder='../frontend', static_url_path='', template_folder='templates')
-CORS(app) 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that encodes and decodes with orjson instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+class CachedJSONRequest(Request):
+    """Request that parses its JSON body only once, however often it is accessed."""
+
+    @cached_property
+    def json_body(self):
+        try:
+            return current_app.json.loads(self.get_data())
+        except ValueError:
+            return None
+
+
+# All routes live on this blueprint; create_app() registers it on the application
+bp = Blueprint('ndvi', __name__)
 
 # Folder for storing generated images
 OUTPUT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
 if not os.path.exists(OUTPUT_FOLDER):
     os.makedirs(OUTPUT_FOLDER)
 
+# Folder for caching processing results, so repeated requests skip the whole pipeline
+RESULT_CACHE_FOLDER = os.path.join(OUTPUT_FOLDER, 'cache', 'results')
+if not os.path.exists(RESULT_CACHE_FOLDER):
+    os.makedirs(RESULT_CACHE_FOLDER)
+
+# Folder for background job status files, shared by all gunicorn workers
+JOB_FOLDER = os.path.join(OUTPUT_FOLDER, 'cache', 'jobs')
+if not os.path.exists(JOB_FOLDER):
+    os.makedirs(JOB_FOLDER)
+
 # Constants for validation
 MAX_ALLOWED_POLYGON_AREA_SQKM = 25.0
 MAX_IMAGES_TO_CONSIDER = 30
+MAX_POLYGON_VERTICES = 5000
+
+# Cached results expire like the scene cache does, so new or reprocessed acquisitions show up
+RESULT_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Background NDVI jobs per worker process, and how long a job may run before it counts as lost
+MAX_CONCURRENT_JOBS = 2
+JOB_TIMEOUT_SECONDS = 30 * 60
+# Job ids are result cache keys (sha256 hex digests)
+_JOB_ID = re.compile(r'[0-9a-f]{64}')
+
+# Generated files are named after a digest of their content (tiles, graph) or of the color scale
+# they are drawn with (legend), so a URL never changes content and browsers may cache it for a year
+OUTPUT_FILE_MAX_AGE = 365 * 24 * 60 * 60
+# Small map layers are inlined into the /process-ndvi response as data URLs. Both limits are base64
+# lengths; larger layers stay on cacheable /output URLs
+MAX_INLINE_LAYER_BYTES = 32 * 1024
+MAX_INLINE_LAYERS_BYTES = 256 * 1024
+# Every generated file is a flat PNG name, so anything else can be rejected in one regex scan
+_SAFE_OUTPUT_FILENAME = re.compile(r'[A-Za-z0-9._-]+\.png')
+# Content types of servable output files, looked up by extension instead of guessed per request
+_OUTPUT_MIMETYPES = {'.png': 'image/png'}
+
+
+class NDVIRequest(BaseModel):
+    """Body of a /process-ndvi request, validated in a single pass by pydantic-core."""
+    polygon: list[tuple[float, float]] = Field(min_length=3, max_length=MAX_POLYGON_VERTICES)
+    startDate: date
+    endDate: date
+    frequency: Literal['weekly', 'monthly']
+
+
+def _run_parameters(params):
+    """Returns the normalised (polygon, start_date_str, end_date_str, frequency) of a validated request."""
+    polygon = [list(point) for point in params.polygon]
+    return polygon, params.startDate.isoformat(), params.endDate.isoformat(), params.frequency
+
+
+def _validation_error_message(error, max_errors=3):
+    """Turns a pydantic ValidationError into a short message the frontend can display."""
+    messages = []
+    for err in error.errors(include_url=False)[:max_errors]:
+        location = '.'.join(str(part) for part in err['loc'])
+        messages.append(f"{location}: {err['msg']}" if location else err['msg'])
+    return "Invalid parameters - " + "; ".join(messages)
+
+
+def _file_to_base64(file_path):
+    with open(file_path, "rb") as f:
+        return base64.b64encode(f.read()).decode('utf-8')
+
+
+def _with_inline_layers(result_data):
+    """
+    Returns a copy of the result where small map layers carry their PNG as a data URL, so the
+    browser does not need a separate /output request per layer. The newest layers, which
+    the map shows first, are inlined first until MAX_INLINE_LAYERS_BYTES is used up; the
+    rest keep their /output URL.
+    """
+    budget = MAX_INLINE_LAYERS_BYTES
+    image_layers = []
+    for layer in reversed(result_data['imageLayers']):
+        layer = dict(layer)
+        image_filepath = os.path.join(OUTPUT_FOLDER, os.path.basename(layer['url']))
+        # Length of the base64 encoding, checked before the file is read
+        encoded_size = 4 * ((os.path.getsize(image_filepath) + 2) // 3)
+        if encoded_size <= MAX_INLINE_LAYER_BYTES and encoded_size <= budget:
+            layer['dataUrl'] = "data:image/png;base64," + _file_to_base64(image_filepath)
+            budget -= encoded_size
+        image_layers.append(layer)
+    image_layers.reverse()
+    return {**result_data, 'imageLayers': image_layers}
+
+
+# Polygons are plain values, so a memoized area never needs invalidating. Entries are keyed on a
+# digest of the polygon, since a polygon of MAX_POLYGON_VERTICES would make a key of ~160 KB
+POLYGON_AREA_CACHE_SIZE = 1024
+_polygon_areas = OrderedDict()
+_polygon_areas_lock = threading.Lock()
+
+
+def _cached_polygon_area_sqkm(polygon):
+    """Returns the polygon area, computing it once per polygon for the last POLYGON_AREA_CACHE_SIZE polygons."""
+    key = hashlib.sha256(json.dumps(polygon, separators=(',', ':')).encode('utf-8')).digest()
+    with _polygon_areas_lock:
+        if key in _polygon_areas:
+            _polygon_areas.move_to_end(key)
+            return _polygon_areas[key]
+    area = calculate_polygon_area_sqkm(polygon)
+    with _polygon_areas_lock:
+        _polygon_areas[key] = area
+        if len(_polygon_areas) > POLYGON_AREA_CACHE_SIZE:
+            _polygon_areas.popitem(last=False)
+    return area
+
+
+# --- Result cache helpers ---
+def _result_cache_key(polygon, start_date_str, end_date_str, frequency):
+    """Builds a stable cache key from the parameters that define a processing run."""
+    canonical = json.dumps(
+        {"polygon": polygon, "startDate": start_date_str, "endDate": end_date_str, "frequency": frequency},
+        sort_keys=True, separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _load_cached_result(key):
+    """Returns the cached result for the key, or None if it is missing, expired or its files are gone."""
+    cache_path = os.path.join(RESULT_CACHE_FOLDER, f"{key}.json")
+    try:
+        if time.time() - os.path.getmtime(cache_path) >= RESULT_CACHE_TTL_SECONDS:
+            return None
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            result_data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # The generated images may have been cleaned up in the meantime
+    file_paths = [os.path.join(OUTPUT_FOLDER, os.path.basename(layer['url'])) for layer in result_data['imageLayers']]
+    if result_data.get('legendPngPath'):
+        file_paths.append(result_data['legendPngPath'])
+    if not all(os.path.exists(path) for path in file_paths):
+        return None
+    return result_data
+
+
+def _atomic_write_json(path, payload):
+    """Writes `payload` as JSON atomically, so concurrent workers never read a half-written file."""
+    try:
+        with atomic_output_path(path) as tmp_path:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(payload, f)
+    except OSError as e:
+        log.error("Failed to write %s: %s", path, e)
+
+
+def _store_cached_result(key, result_data):
+    _atomic_write_json(os.path.join(RESULT_CACHE_FOLDER, f"{key}.json"), result_data)
+
+
+def get_ndvi_result(polygon, start_date_str, end_date_str, frequency):
+    """Returns the NDVI result for the parameters, running `process_ndvi` only on a cache miss."""
+    key = _result_cache_key(polygon, start_date_str, end_date_str, frequency)
+    result_data = _load_cached_result(key)
+    if result_data is not None:
+        log.info("Serving cached NDVI result %s", key[:12])
+        return result_data
+
+    result_data = process_ndvi(
+        polygon_coords=polygon,
+        start_date_str=start_date_str,
+        end_date_str=end_date_str,
+        frequency=frequency,
+        max_images_to_consider=MAX_IMAGES_TO_CONSIDER,
+        max_polygon_area_sqkm=MAX_ALLOWED_POLYGON_AREA_SQKM
+    )
+    if result_data and result_data.get("imageLayers"):
+        _store_cached_result(key, result_data)
+    return result_data
+
+
+# --- Background job helpers ---
+# Jobs run in this pool so /process-ndvi can answer immediately instead of holding the connection
+_job_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix='ndvi-job')
+# Ids of the jobs queued or running in this process; the lock makes checking and submitting one step,
+# so concurrent identical requests on the threads of one worker cannot both start a job
+_active_job_ids = set()
+_active_job_ids_lock = threading.Lock()
+
+
+def _write_job_status(job_id, status):
+    _atomic_write_json(os.path.join(JOB_FOLDER, f"{job_id}.json"), status)
+
+
+def _read_job_status(job_id):
+    """Returns the stored job status, or None for unknown jobs. Jobs lost with their worker time out."""
+    job_path = os.path.join(JOB_FOLDER, f"{job_id}.json")
+    try:
+        with open(job_path, 'r', encoding='utf-8') as f:
+            status = json.load(f)
+        age = time.time() - os.path.getmtime(job_path)
+    except (OSError, ValueError):
+        return None
+    if status.get('status') in ('queued', 'running') and age > JOB_TIMEOUT_SECONDS:
+        return {"status": "failed", "error": "NDVI processing timed out"}
+    return status
+
+
+def _run_ndvi_job(job_id, polygon, start_date_str, end_date_str, frequency):
+    try:
+        _write_job_status(job_id, {"status": "running"})
+        try:
+            result_data = get_ndvi_result(polygon, start_date_str, end_date_str, frequency)
+        except Exception as e:
+            log.exception("An unexpected error occurred during NDVI processing.")
+            _write_job_status(job_id, {"status": "failed", "error": f"An unexpected error occurred: {str(e)}"})
+            return
+        if result_data and result_data.get("imageLayers"):
+            _write_job_status(job_id, {"status": "finished"})
+        else:
+            _write_job_status(job_id, {"status": "failed", "error": "NDVI processing failed or no suitable satellite data found"})
+    finally:
+        with _active_job_ids_lock:
+            _active_job_ids.discard(job_id)
+
+
+def submit_ndvi_job(polygon, start_date_str, end_date_str, frequency):
+    """
+    Queues an NDVI job and returns its id. The id is the result cache key, so identical
+    submissions share one job instead of processing the same field twice.
+    """
+    job_id = _result_cache_key(polygon, start_date_str, end_date_str, frequency)
+    with _active_job_ids_lock:
+        if job_id in _active_job_ids:
+            return job_id
+        # The status file covers jobs started by the other worker processes
+        status = _read_job_status(job_id)
+        if status is None or status['status'] not in ('queued', 'running'):
+            _active_job_ids.add(job_id)
+            _write_job_status(job_id, {"status": "queued"})
+            _job_executor.submit(_run_ndvi_job, job_id, polygon, start_date_str, end_date_str, frequency)
+    return job_id
+
 
 # Route for serving the main page (index.html)
-@app.route('/')
+@bp.route('/')
 def serve_index():
-    return send_from_directory(app.static_folder, 'index.html')
+    return send_from_directory(current_app.static_folder, 'index.html')
 
 # Main endpoint for NDVI processing
-@app.route('/process-ndvi', methods=['POST'])
+@bp.route('/process-ndvi', methods=['POST'])
 def handle_process_ndvi():
     # ... (tato funkce zůstává úplně stejná) ...
-    data = request.json
+    if request.content_length and request.content_length > current_app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({"error": "Request body is too large"}), 413
+    data = request.json_body
     if not data:
-        logging.error("No data in request.")
+        log.error("No data in request.")
         return jsonify({"error": "No data provided"}), 400
-    polygon = data.get('polygon')
-    start_date_str = data.get('startDate')
-    end_date_str = data.get('endDate')
-    frequency = data.get('frequency')
-    if not all([polygon, start_date_str, end_date_str, frequency]):
-        return jsonify({"error": "Missing parameters"}), 400
     try:
-        result_data = process_ndvi(
-            polygon_coords=polygon,
-            start_date_str=start_date_str,
-            end_date_str=end_date_str,
-            frequency=frequency,
-            max_images_to_consider=MAX_IMAGES_TO_CONSIDER,
-            max_polygon_area_sqkm=MAX_ALLOWED_POLYGON_AREA_SQKM
-        )
-        if result_data and result_data.get("imageLayers"):
-            return jsonify(result_data)
-        else:
-            return jsonify({"error": "NDVI processing failed or no suitable satellite data found"}), 500
+        params = NDVIRequest.model_validate(data)
+    except ValidationError as e:
+        return jsonify({"error": _validation_error_message(e)}), 400
+    polygon, start_date_str, end_date_str, frequency = _run_parameters(params)
+    try:
+        # Reject oversized polygons before any satellite data is requested. A polygon is never
+        # larger than its bounding box, so the exact area is only needed for larger boxes.
+        if bbox_area_upper_bound_sqkm(polygon) > MAX_ALLOWED_POLYGON_AREA_SQKM:
+            area = _cached_polygon_area_sqkm(polygon)
+            if area > MAX_ALLOWED_POLYGON_AREA_SQKM:
+                return jsonify({"error": f"Polygon area ({area:.2f} km²) exceeds the maximum allowed size ({MAX_ALLOWED_POLYGON_AREA_SQKM} km²)."}), 400
+        # Cached results are returned right away; everything else runs as a background job
+        result_data = _load_cached_result(_result_cache_key(polygon, start_date_str, end_date_str, frequency))
+        if result_data is not None:
+            return jsonify(_with_inline_layers(result_data))
+        job_id = submit_ndvi_job(polygon, start_date_str, end_date_str, frequency)
+        return jsonify({"jobId": job_id}), 202
     except Exception as e:
-        logging.exception("An unexpected error occurred during NDVI processing.")
+        log.exception("An unexpected error occurred during NDVI processing.")
         return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
 
 
+# Polling endpoint for background NDVI jobs
+@bp.route('/status/<job_id>')
+def handle_job_status(job_id):
+    if not _JOB_ID.fullmatch(job_id):
+        return jsonify({"error": "Invalid job id"}), 400
+    result_data = _load_cached_result(job_id)
+    if result_data is not None:
+        return jsonify({"status": "finished", "result": _with_inline_layers(result_data)})
+    status = _read_job_status(job_id)
+    if status is None:
+        return jsonify({"error": "Unknown job"}), 404
+    # A finished job is only as good as its cached result, which may have failed to write or
+    # lost its images since
+    if status['status'] == 'finished':
+        return jsonify({"status": "failed", "error": "The NDVI result is no longer available, please process the field again"})
+    return jsonify(status)
+
+
 # --- NEW: Endpoint for exporting HTML report ---
-@app.route('/export-html')
+@bp.route('/export-html')
 def export_html_report():
     try:
         # Get parameters from URL query string
@@ -75,50 +359,54 @@ def export_html_report():
         if not all([start_date, end_date, frequency, polygon_str]):
             return "Error: Missing parameters in URL.", 400
         
-        # Convert polygon string back to list of lists
-        polygon = json.loads(polygon_str)
-
-        # Re-run the processing to get the data and generate images
-        # Note: In a production app, you might cache this result to avoid re-processing.
-        result_data = process_ndvi(
-            polygon_coords=polygon,
-            start_date_str=start_date,
-            end_date_str=end_date,
-            frequency=frequency
-        )
+        # Validate and normalise exactly like /process-ndvi, so both build the same cache key
+        try:
+            polygon = json.loads(polygon_str)
+        except ValueError:
+            return "Error: Invalid parameters - polygon is not valid JSON.", 400
+        try:
+            params = NDVIRequest.model_validate(
+                {'polygon': polygon, 'startDate': start_date, 'endDate': end_date, 'frequency': frequency}
+            )
+        except ValidationError as e:
+            return f"Error: {_validation_error_message(e)}", 400
+        polygon, start_date, end_date, frequency = _run_parameters(params)
+
+        # Reuse the cached result of the preceding /process-ndvi call; processing inline would
+        # run the whole pipeline inside this request and hit the gunicorn timeout
+        result_data = _load_cached_result(_result_cache_key(polygon, start_date, end_date, frequency))
+
+        if result_data is None:
+            return "Error: No NDVI result for these parameters. Process the field first, then export the report.", 409
+
+        # The graph image is only needed here, so it is rendered on demand; the legend is part of the result
+        graph_path = render_graph_png(result_data['graphData'])
+        if not graph_path:
+            return "Error: Could not generate the graph for the report.", 500
+        graph_base64 = _file_to_base64(graph_path)
+        legend_base64 = _file_to_base64(result_data['legendPngPath'])
 
-        if not result_data:
-            return "Error: Could not generate data for the report.", 500
-
-        # --- Base64 Encoding Magic ---
-        def to_base64(file_path):
-            with open(file_path, "rb") as f:
-                return base64.b64encode(f.read()).decode('utf-8')
-
-        # The graph and legend are part of the main result now
-        graph_base64 = to_base64(result_data['graphPngPath'])
-        legend_base64 = to_base64(result_data['legendPngPath'])
-
-        # Prepare map data for the template
-        maps_data_for_template = []
-        for layer in result_data['imageLayers']:
-            # layer['url'] is like '/output/ndvi_map_2025-07-25...png'
-            # We need the full file system path.
-            image_filename = os.path.basename(layer['url'])
-            image_filepath = os.path.join(OUTPUT_FOLDER, image_filename)
-            maps_data_for_template.append({
-                'date': layer['date'],
-                'src': to_base64(image_filepath)
-            })
+        # Map data for the template, encoded one image at a time as the report streams out
+        def maps_data_for_template():
+            for layer in result_data['imageLayers']:
+                # layer['url'] is like '/output/ndvi_map_2025-07-25...png'
+                # We need the full file system path.
+                image_filename = os.path.basename(layer['url'])
+                image_filepath = os.path.join(OUTPUT_FOLDER, image_filename)
+                yield {
+                    'date': layer['date'],
+                    'src': _file_to_base64(image_filepath)
+                }
         
-        # Render the HTML template with our data
-        html_report = render_template('report_template.html', 
+        # Stream the rendered template in chunks instead of building the whole
+        # multi-megabyte report in memory first
+        html_report = stream_template('report_template.html', 
                                       start_date=start_date,
                                       end_date=end_date,
                                       frequency=frequency.capitalize(),
                                       graph_base64=graph_base64,
                                       legend_base64=legend_base64,
-                                      maps=maps_data_for_template)
+                                      maps=maps_data_for_template())
         
         # Return the rendered HTML as a downloadable file
         return Response(
@@ -128,22 +416,55 @@ def export_html_report():
         )
 
     except Exception as e:
-        logging.exception("Error generating HTML report.")
+        log.exception("Error generating HTML report.")
         return f"An error occurred while generating the report: {e}", 500
 
 
 # Route for serving generated files (images)
-@app.route('/output/<filename>')
+@bp.route('/output/<filename>')
 def serve_output_file(filename):
-    # ... (tato funkce zůstává stejná) ...
-    if ".." in filename or filename.startswith("/"):
+    if not _SAFE_OUTPUT_FILENAME.fullmatch(filename):
         return jsonify({"error": "Invalid filename"}), 400
-    file_path = os.path.join(OUTPUT_FOLDER, filename)
-    if os.path.exists(file_path):
-        return send_file(file_path, as_attachment=False)
-    else:
+    mimetype = _OUTPUT_MIMETYPES.get(os.path.splitext(filename)[1].lower(), 'application/octet-stream')
+    x_accel_redirect_prefix = current_app.config['X_ACCEL_REDIRECT_PREFIX']
+    if x_accel_redirect_prefix:
+        # nginx streams the file itself and handles caching headers for the internal location
+        return Response(headers={'X-Accel-Redirect': x_accel_redirect_prefix + filename}, mimetype=mimetype)
+    try:
+        # Werkzeug's static file path: rejects traversal, adds an ETag and answers
+        # If-None-Match with 304 Not Modified
+        response = send_from_directory(OUTPUT_FOLDER, filename, mimetype=mimetype, conditional=True, max_age=OUTPUT_FILE_MAX_AGE)
+    except NotFound:
         return jsonify({"error": "File not found"}), 404
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+def create_app(config=None):
+    """Builds the Flask application; `config` overrides the environment-based defaults."""
+    # Tell Flask where to find the templates folder
+    app = Flask(__name__, static_folder='../frontend', static_url_path='', template_folder='templates')
+    app.request_class = CachedJSONRequest
+    app.json = OrjsonProvider(app)
+    # Werkzeug rejects larger bodies before they are read into memory
+    app.config['MAX_CONTENT_LENGTH'] = 256 * 1024
+    # Behind Apache/lighttpd, hand output file transfers to the web server via X-Sendfile
+    app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+    # Behind nginx, set this to an internal location aliased to the output folder, e.g. '/output_internal/'
+    app.config['X_ACCEL_REDIRECT_PREFIX'] = os.getenv('X_ACCEL_REDIRECT_PREFIX')
+    # Compress JSON results and HTML reports; PNG output is already compressed
+    app.config['COMPRESS_MIMETYPES'] = ['application/json', 'text/html']
+    if config:
+        app.config.update(config)
+    CORS(app)
+    Compress(app)
+    app.register_blueprint(bp)
+    return app
+
+
+# Application instance used by gunicorn (backend.app:app)
+app = create_app()
 
-# Run the application
+# Run the development server; production runs under gunicorn (see Procfile)
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    app.run(debug=os.getenv('FLASK_DEBUG') == '1', port=5000)
\ No newline at end of file
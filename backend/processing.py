@@ -1,28 +1,38 @@
 import os
 import numpy as np
-import rasterio
 from sentinelhub import (
     SHConfig, SentinelHubRequest, DataCollection, MimeType, CRS, BBox, bbox_to_dimensions,
-    SentinelHubCatalog
+    SentinelHubCatalog, SentinelHubDownloadClient
 )
-from datetime import date, timedelta, datetime
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import date, timedelta
+from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
 import logging
-from shapely.geometry import Polygon
+from pyproj import Geod
 import math
-import sys
+import bisect
+import json
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from numba import njit
 
-# Matplotlib is still needed for generating PNG images
-import matplotlib
-matplotlib.use('Agg') # Setting the non-interactive backend is still important for the server
-import matplotlib.pyplot as plt
-import matplotlib.colorbar
+# Matplotlib is only needed for the palette, the legend and the report graph, so it is imported on
+# first use inside those functions instead of with this module. They use the object API with the Agg
+# canvas and never import pyplot, so no backend has to be selected and no global state is shared
 
-# From rasterio, we need transform for georeferencing images
-from rasterio.transform import from_bounds
+# Pillow encodes the NDVI map tiles
+from PIL import Image
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+log = logging.getLogger(__name__)
 
 # Loading .env variables
 load_dotenv()
@@ -30,7 +40,7 @@ CDSE_CLIENT_ID = os.getenv("CDSE_CLIENT_ID")
 CDSE_CLIENT_SECRET = os.getenv("CDSE_CLIENT_SECRET")
 
 if not all([CDSE_CLIENT_ID, CDSE_CLIENT_SECRET]):
-    logging.error("Missing environment variables for CDSE (CDSE_CLIENT_ID/SECRET). Check the .env file.")
+    log.error("Missing environment variables for CDSE (CDSE_CLIENT_ID/SECRET). Check the .env file.")
     raise ValueError("Missing CDSE API keys in the .env file.")
 
 # Sentinel Hub configuration for Copernicus Data Space Ecosystem (CDSE)
@@ -41,10 +51,56 @@ _GLOBAL_CDSE_CONFIG.sh_base_url = "https://sh.dataspace.copernicus.eu"
 _GLOBAL_CDSE_CONFIG.sh_token_url = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
 _GLOBAL_CDSE_CONFIG.sh_auth_base_url = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect"
 
-logging.info(f"Global SHConfig Base URL: {_GLOBAL_CDSE_CONFIG.sh_base_url}")
+log.info("Global SHConfig Base URL: %s", _GLOBAL_CDSE_CONFIG.sh_base_url)
 
-# Initialize catalog for searching images
-catalog = SentinelHubCatalog(config=_GLOBAL_CDSE_CONFIG)
+# sentinelhub sends every request through a bare requests.request(), which opens a new TCP+TLS
+# connection each time; one shared session keeps connections to CDSE alive across all requests
+# and threads (the pool is sized for both jobs' interval workers at once)
+_HTTP_SESSION = requests.Session()
+_HTTP_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.3)
+))
+# Requests in flight to CDSE at once per worker process, across its jobs and their interval workers, so
+# concurrent jobs do not multiply into HTTP 429 responses (override with NDVI_MAX_CONCURRENT_REQUESTS).
+# Each gunicorn worker has its own limit, so the overall cap is WEB_CONCURRENCY times this value
+_CDSE_REQUEST_SLOTS = threading.BoundedSemaphore(int(os.getenv("NDVI_MAX_CONCURRENT_REQUESTS", "8")))
+
+
+class _PooledDownloadClient(SentinelHubDownloadClient):
+    """
+    A SentinelHubDownloadClient that sends its requests through the shared keep-alive session,
+    holding one of the CDSE request slots while a request is in flight.
+    """
+
+    def _do_download(self, request):
+        if request.url is None:
+            raise ValueError(f"Faulty request {request}, no URL specified.")
+
+        # Headers are prepared first, so a token refresh does not occupy a slot
+        headers = self._prepare_headers(request)
+        with _CDSE_REQUEST_SLOTS:
+            return _HTTP_SESSION.request(
+                request.request_type.value,
+                url=request.url,
+                json=request.post_values,
+                headers=headers,
+                timeout=self.config.download_timeout_seconds,
+            )
+
+
+# Catalog clients for searching images, one per thread: a download client's lock and rate limit
+# state are reset by every download() call, so one instance must not serve concurrent searches
+_thread_local = threading.local()
+
+
+def _get_catalog():
+    """Returns the catalog client of the calling thread, creating it on first use."""
+    catalog = getattr(_thread_local, 'catalog', None)
+    if catalog is None:
+        catalog = _thread_local.catalog = SentinelHubCatalog(config=_GLOBAL_CDSE_CONFIG)
+        # The client stores its retry time in milliseconds but takes it in seconds
+        catalog.client = _PooledDownloadClient(config=_GLOBAL_CDSE_CONFIG, default_retry_time=SentinelHubCatalog._DEFAULT_RETRY_TIME)
+    return catalog
 
 # Define a custom data collection for CDSE
 DataCollection.define(
@@ -61,31 +117,518 @@ DataCollection.define(
 )
 S2_L2A_CDSE_CUSTOM = DataCollection.SENTINEL2_L2A_CDSE_CUSTOM
 
-# ----- FUNCTION FOR AREA CALCULATION (remains unchanged) -----
+# WGS84 ellipsoid for geodesic area calculations (the computation itself runs in PROJ's C code)
+_GEOD = Geod(ellps='WGS84')
+# Largest radius of curvature of the WGS84 ellipsoid (reached at the poles), in km
+_MAX_CURVATURE_RADIUS_KM = 6378.137 ** 2 / 6356.752314245
+
+# ----- FUNCTION FOR AREA CALCULATION -----
 def calculate_polygon_area_sqkm(polygon_coords: list) -> float:
     """
-    Calculates the approximate area of a polygon in km^2.
+    Calculates the geodesic area of a polygon given as [lon, lat] pairs in km^2.
     """
     if not polygon_coords or len(polygon_coords) < 3:
         return 0.0
     try:
-        polygon_shape = Polygon(polygon_coords)
+        # The vertex arrays go straight to PROJ, without building a Shapely geometry first;
+        # the ring is closed implicitly, so a repeated first vertex only adds an empty edge
+        coords = np.asarray(polygon_coords, dtype=np.float64)
+        area_sqm, _ = _GEOD.polygon_area_perimeter(coords[:, 0], coords[:, 1])
     except Exception as e:
-        logging.error(f"Error creating Shapely polygon: {e}")
+        log.error("Error calculating geodesic polygon area: %s", e)
         return 0.0
-    centroid_lat = polygon_shape.centroid.y
-    lat_rad = math.radians(centroid_lat)
-    km_per_deg_lon = 111.32 * math.cos(lat_rad)
-    km_per_deg_lat = 110.574
-    approx_projected_coords = []
-    for lon, lat in polygon_coords:
-        approx_projected_coords.append((lon * km_per_deg_lon, lat * km_per_deg_lat))
+    # The sign only reflects the vertex order
+    return abs(area_sqm) / 1e6
+
+def bbox_area_upper_bound_sqkm(polygon_coords: list) -> float:
+    """
+    Returns a cheap upper bound of the polygon area in km^2: the area of its lon/lat bounding box
+    on a sphere with the ellipsoid's largest radius of curvature, scaled by the cosine of the
+    box latitude closest to the equator. It never underestimates the geodesic area.
+    """
+    coords = np.asarray(polygon_coords, dtype=np.float64)
+    min_lon, min_lat = coords.min(axis=0)
+    max_lon, max_lat = coords.max(axis=0)
+    lat_closest_to_equator = 0.0 if min_lat <= 0.0 <= max_lat else min(abs(min_lat), abs(max_lat))
+    return (
+        _MAX_CURVATURE_RADIUS_KM ** 2
+        * math.radians(max_lon - min_lon)
+        * math.radians(max_lat - min_lat)
+        * math.cos(math.radians(lat_closest_to_equator))
+    )
+
+# NDVI maps are stored as int16 NDVI * 10000 (the MODIS encoding), with a dedicated "no data" value
+NDVI_SCALE = 10000
+NDVI_NODATA = -32768
+
+# Evalscripts travel with every request, so they are kept compact and built only once
+# CLOUD EVALSCRIPT: Fetches only the SCL (Scene Classification Layer), enough to score every candidate image.
+# "No data" pixels get SCL class 0 (NO_DATA), so no separate dataMask band is downloaded
+_EVALSCRIPT_CLOUD_MASK = (
+    '//VERSION=3\n'
+    'function setup(){return{input:[{bands:["SCL","dataMask"]}],'
+    'output:[{id:"cloud_mask",bands:1,sampleType:SampleType.UINT8}]};}'
+    'function evaluatePixel(s){return{cloud_mask:[s.dataMask?s.SCL:0]};}'
+)
+# NDVI EVALSCRIPT: Computes NDVI from B04(RED) and B08(NIR) server-side, only for the best image of each
+# interval, and returns it already in the int16 map encoding: one INT16 band instead of two UINT16 bands.
+# Digital numbers keep the ratio exact up to the rounding; "no data" pixels get NDVI_NODATA
+_EVALSCRIPT_NDVI = (
+    '//VERSION=3\n'
+    'function setup(){return{input:[{bands:["B04","B08","dataMask"],units:"DN"}],'
+    'output:[{id:"ndvi",bands:1,sampleType:SampleType.INT16}]};}'
+    'function evaluatePixel(s){var t=s.B08+s.B04;'
+    f'return{{ndvi:[s.dataMask&&t>0?Math.round({NDVI_SCALE}*(s.B08-s.B04)/t):{NDVI_NODATA}]}};}}'
+)
+# Each evalscript has a single output, always downloaded as one TIFF; the response specs never
+# change, so they are built once instead of for every request
+_TIFF_RESPONSES = {
+    output_id: [SentinelHubRequest.output_response(output_id, MimeType.TIFF)]
+    for output_id in ("cloud_mask", "ndvi")
+}
+
+# The maximum duration of the time series
+MAX_TIME_SERIES_DAYS = 365
+
+# Sentinel-2 B04/B08 resolution, and the largest image side worth downloading for the map overlay
+NATIVE_RESOLUTION_M = 10
+MAX_IMAGE_DIMENSION_PX = 1200
+# Sentinel-2's native band resolutions; coarser requests are snapped up to one of them (or to a
+# multiple of the coarsest) so the grid matches a native one instead of an arbitrary resampling
+RESOLUTION_TIERS_M = (10, 20, 60)
+
+# In the SCL band, cloud and shadow values are 3 (shadow), 8 (med-prob cloud), 9 (high-prob cloud), 10 (thin cirrus)
+CLOUD_SCL_VALUES = [3, 8, 9, 10]
+# Lookup table over every UINT8 SCL value, so cloudy pixels are flagged with one indexing pass
+_IS_CLOUD_SCL = np.zeros(256, dtype=bool)
+_IS_CLOUD_SCL[CLOUD_SCL_VALUES] = True
+
+# Time intervals processed concurrently; each one mostly waits on CDSE requests
+# (override with NDVI_INTERVAL_WORKERS to match the CDSE account's rate limits)
+MAX_INTERVAL_WORKERS = int(os.getenv("NDVI_INTERVAL_WORKERS", "8"))
+
+# Largest page the Catalog API returns per request
+CATALOG_PAGE_SIZE_LIMIT = 100
+
+
+# Folder for caching catalog searches and downloaded bands, so repeated queries over the same
+# area skip the CDSE round trips
+OUTPUT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
+@contextmanager
+def atomic_output_path(path):
+    """
+    Yields a temporary path, unique to the calling process and thread, to write the file for `path`
+    to, and moves it into place once the block succeeds, so concurrent readers never see a partial
+    file and concurrent writers of the same file each write their own (the last rename wins). The
+    temporary file is removed if the block raises.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
     try:
-        approx_projected_polygon = Polygon(approx_projected_coords)
-        return approx_projected_polygon.area
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+SCENE_CACHE_FOLDER = os.path.join(OUTPUT_FOLDER, 'cache', 'scenes')
+if not os.path.exists(SCENE_CACHE_FOLDER):
+    os.makedirs(SCENE_CACHE_FOLDER)
+# Scenes can be reprocessed upstream and new acquisitions appear, so cached entries expire
+SCENE_CACHE_TTL_SECONDS = 24 * 60 * 60
+# Disk budget for the scene cache; the oldest entries are evicted once it is exceeded
+SCENE_CACHE_MAX_BYTES = int(os.getenv("NDVI_SCENE_CACHE_MB", "2048")) * 1024 * 1024
+# Only one thread scans the cache folder at a time; the others skip eviction
+_scene_cache_prune_lock = threading.Lock()
+
+
+def _scene_cache_key(**params):
+    """Builds a stable cache key from the parameters that define a search or download."""
+    canonical = json.dumps(params, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=20).hexdigest()
+
+
+def _cached_or_fetch(key, fetch_fn, as_arrays=False):
+    """
+    Returns the cached value for `key` if it is younger than SCENE_CACHE_TTL_SECONDS, otherwise
+    calls `fetch_fn` and caches its result. Values are JSON, or dicts of arrays with `as_arrays`.
+    """
+    cache_path = os.path.join(SCENE_CACHE_FOLDER, f"{key}.npz" if as_arrays else f"{key}.json")
+    try:
+        if time.time() - os.path.getmtime(cache_path) < SCENE_CACHE_TTL_SECONDS:
+            if as_arrays:
+                with np.load(cache_path) as cached:
+                    return {name: cached[name] for name in cached.files}
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        log.warning("Ignoring unreadable scene cache entry %s: %s", cache_path, e)
+
+    value = fetch_fn()
+    # A failed write removes its temporary file, so none is left behind outside the cache budget
+    try:
+        with atomic_output_path(cache_path) as tmp_path:
+            if as_arrays:
+                with open(tmp_path, 'wb') as f:
+                    # SCL masks and integer bands deflate well, so more scenes fit in the cache budget
+                    np.savez_compressed(f, **value)
+            else:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(value, f)
+    except OSError as e:
+        log.warning("Failed to write scene cache entry %s: %s", cache_path, e)
+    if _scene_cache_prune_lock.acquire(blocking=False):
+        try:
+            _prune_scene_cache()
+        finally:
+            _scene_cache_prune_lock.release()
+    return value
+
+
+def _prune_scene_cache():
+    """
+    Deletes expired scene cache entries, then the oldest remaining ones until the cache fits
+    in SCENE_CACHE_MAX_BYTES. Temporary files are left to the writes in progress, unless they
+    are older than SCENE_CACHE_TTL_SECONDS and were left behind by a killed worker.
+    """
+    entries = []
+    now = time.time()
+    try:
+        with os.scandir(SCENE_CACHE_FOLDER) as scan:
+            for entry in scan:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith('.tmp'):
+                    if now - stat.st_mtime >= SCENE_CACHE_TTL_SECONDS:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError as e:
+        log.warning("Failed to scan the scene cache: %s", e)
+        return
+
+    # Oldest first, so expired entries are always reached before any that are still valid
+    entries.sort()
+    total_bytes = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if total_bytes <= SCENE_CACHE_MAX_BYTES and now - mtime < SCENE_CACHE_TTL_SECONDS:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning("Failed to evict scene cache entry %s: %s", path, e)
+            continue
+        total_bytes -= size
+
+
+def _fetch_band_stack(evalscript, output_id, bbox, size, image_date):
+    """
+    Downloads the single output `output_id` of an evalscript as one TIFF for one acquisition date,
+    through the scene cache. Returns the decoded array, of shape (height, width, bands) or, for a
+    single band, possibly (height, width).
+    """
+    def download():
+        # A date object is taken as the whole day, so granules of the same acquisition that overlap
+        # the bbox are mosaicked; it also skips sentinelhub's string parsing of both bounds
+        acquisition_day = date.fromisoformat(image_date)
+        request = SentinelHubRequest(
+            evalscript=evalscript,
+            input_data=[SentinelHubRequest.input_data(
+                data_collection=S2_L2A_CDSE_CUSTOM,
+                time_interval=(acquisition_day, acquisition_day)
+            )],
+            responses=_TIFF_RESPONSES[output_id],
+            bbox=bbox, size=size, config=_GLOBAL_CDSE_CONFIG
+        )
+        # get_data() builds a new client on every call; make it one that uses the pooled session
+        request.download_client_class = _PooledDownloadClient
+        # save_data=False saves disk space; the scene cache keeps only the decoded arrays
+        return {output_id: request.get_data(save_data=False)[0]}
+
+    # The evalscript defines the bands, their order and sample type, so a changed script never reads old entries
+    download_key = _scene_cache_key(
+        kind='download', evalscript=evalscript, output=output_id, bbox=list(bbox), size=list(size), date=image_date
+    )
+    return _cached_or_fetch(download_key, download, as_arrays=True)[output_id]
+
+
+# Generated PNGs are served straight to the browser, so the fastest zlib level beats a slightly smaller file
+PNG_SAVE_OPTIONS = {'compress_level': 1}
+
+# Color scale shared by the map tiles and the legend
+NDVI_CMAP_NAME = 'RdYlGn'
+NDVI_VMIN = -0.2
+NDVI_VMAX = 1.0
+# The color scale limits in the int16 map encoding
+_NDVI_VMIN_SCALED = round(NDVI_VMIN * NDVI_SCALE)
+_NDVI_VMAX_SCALED = round(NDVI_VMAX * NDVI_SCALE)
+
+
+@lru_cache(maxsize=1)
+def _ndvi_palette():
+    """
+    Returns the 256-entry RGBA lookup table of the NDVI color scale, so map tiles are colored with
+    plain array indexing. It only depends on the color scale, so it is built once, on first use.
+    """
+    import matplotlib
+    cmap = matplotlib.colormaps[NDVI_CMAP_NAME]
+    return (cmap(np.linspace(0, 1, 256)) * 255).astype(np.uint8)
+
+
+# The legend only depends on the color scale, so one file serves every run; it is rendered the first
+# time a result needs it. Like the map tiles, it is named after the color scale, so changing the scale
+# renders a new file under a new URL instead of serving the stale one
+_LEGEND_DIGEST = hashlib.blake2b(repr((NDVI_CMAP_NAME, NDVI_VMIN, NDVI_VMAX)).encode('utf-8'), digest_size=8).hexdigest()
+STATIC_LEGEND_PATH = os.path.join(OUTPUT_FOLDER, f'legend_{_LEGEND_DIGEST}.png')
+
+
+def _static_legend_path():
+    """Returns the path of the colorbar legend PNG, rendering it if it is missing, or None on failure."""
+    if os.path.exists(STATIC_LEGEND_PATH):
+        return STATIC_LEGEND_PATH
+    try:
+        import matplotlib
+        import matplotlib.colorbar
+        from matplotlib.colors import Normalize
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig_legend = Figure(figsize=(5, 0.8), dpi=100)
+        FigureCanvasAgg(fig_legend)
+        ax_legend = fig_legend.add_subplot()
+        cbar = matplotlib.colorbar.ColorbarBase(
+            ax_legend, cmap=matplotlib.colormaps[NDVI_CMAP_NAME], norm=Normalize(vmin=NDVI_VMIN, vmax=NDVI_VMAX),
+            orientation='horizontal'
+        )
+        ax_legend.set_title("NDVI Value")
+        fig_legend.tight_layout()
+        # Several workers may render it at once; each writes its own file and the last rename wins
+        with atomic_output_path(STATIC_LEGEND_PATH) as tmp_path:
+            fig_legend.savefig(tmp_path, format='png', transparent=True, pil_kwargs=PNG_SAVE_OPTIONS)
     except Exception as e:
-        logging.error(f"Error calculating area of approximated polygon: {e}")
-        return 0.0
+        log.error("Failed to generate legend image: %s", e)
+        return None
+    return STATIC_LEGEND_PATH
+
+
+# One graph figure is reused for every export instead of building a new figure and axes tree each
+# time; the lock serializes renders, since concurrent requests would otherwise draw on the same axes
+_graph_figure = None
+_graph_figure_lock = threading.Lock()
+
+
+def render_graph_png(graph_data):
+    """
+    Renders the NDVI time series graph for `graph_data` (the "graphData" of a result) and returns
+    its path, or None if there is nothing to plot or rendering fails. Only the HTML report needs
+    this image, so it is rendered on demand rather than on every processing run; the file name is
+    derived from the data, so repeated exports reuse it.
+    """
+    global _graph_figure
+    plot_data = [item for item in graph_data if item.get('value') is not None]
+    if not plot_data:
+        return None
+    digest = hashlib.blake2b(json.dumps(plot_data, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+    graph_path = os.path.join(OUTPUT_FOLDER, f"graph_{digest}.png")
+    if os.path.exists(graph_path):
+        return graph_path
+    try:
+        dates = [date.fromisoformat(item['date']) for item in plot_data]
+        values = [item['value'] for item in plot_data]
+        with _graph_figure_lock, atomic_output_path(graph_path) as tmp_path:
+            if _graph_figure is None:
+                from matplotlib.figure import Figure
+                from matplotlib.backends.backend_agg import FigureCanvasAgg
+                _graph_figure = Figure(figsize=(10, 5), dpi=100)
+                FigureCanvasAgg(_graph_figure)
+                _graph_figure.add_subplot()
+            fig_graph = _graph_figure
+            ax_graph = fig_graph.axes[0]
+            # Clearing the axes drops the previous plot, title and tick settings
+            ax_graph.cla()
+            ax_graph.plot(dates, values, marker='o', linestyle='-', color='green')
+            ax_graph.set_title("NDVI Time Series", fontsize=16)
+            ax_graph.set_ylabel("Average NDVI")
+            ax_graph.grid(True, linestyle='--', alpha=0.6)
+            ax_graph.tick_params(axis='x', rotation=45)
+            fig_graph.tight_layout()
+            fig_graph.savefig(tmp_path, format='png', pil_kwargs=PNG_SAVE_OPTIONS)
+    except Exception as e:
+        log.error("Failed to generate graph image: %s", e)
+        return None
+    return graph_path
+
+
+# nogil lets the interval worker threads run the kernel concurrently
+@njit(nogil=True, cache=True)
+def _ndvi_sum_and_count(ndvi):
+    """
+    Returns the exact integer sum and the count of the valid (not NDVI_NODATA) values of the int16
+    NDVI map `ndvi` in a single pass, without building a mask or a compressed copy.
+    """
+    ndvi_sum = 0
+    valid_pixel_count = 0
+    height, width = ndvi.shape
+    for i in range(height):
+        for j in range(width):
+            value = ndvi[i, j]
+            if value != NDVI_NODATA:
+                ndvi_sum += value
+                valid_pixel_count += 1
+    return ndvi_sum, valid_pixel_count
+
+
+def _search_images_by_interval(bbox, time_series_intervals, max_images_to_consider):
+    """
+    Searches the catalog once for the whole time series and groups the found images by interval.
+    Returns one list of catalog features per interval, in the order of `time_series_intervals`,
+    with at most one feature per acquisition date.
+    """
+    images_by_interval = [[] for _ in time_series_intervals]
+    if not time_series_intervals:
+        return images_by_interval
+
+    # The last weekly interval may end after the requested end date, so search up to its end
+    search_start_str, search_end_str = time_series_intervals[0][0], time_series_intervals[-1][1]
+    log.info("Searching for images from %s to %s", search_start_str, search_end_str)
+    # `limit` is only the page size, the iterator always yields every match; the Catalog API caps it at 100
+    page_size = min(CATALOG_PAGE_SIZE_LIMIT, max_images_to_consider * len(time_series_intervals))
+    # We search in L2A data, without a strict cloud filter
+    search_key = _scene_cache_key(kind='search', bbox=list(bbox), interval=[search_start_str, search_end_str])
+    results = _cached_or_fetch(search_key, lambda: list(_get_catalog().search(
+        S2_L2A_CDSE_CUSTOM, bbox=bbox, time=(search_start_str, search_end_str), limit=page_size
+    )))
+
+    # Intervals are contiguous and chronological, so an image belongs to the first interval
+    # ending on or after its acquisition date (ISO date strings sort chronologically)
+    interval_ends = [ts_end_str for _, ts_end_str in time_series_intervals]
+    seen_dates = set()
+    for image_meta in results:
+        image_date = image_meta['properties']['datetime'][:10]
+        # Overlapping granules of one acquisition are separate catalog features, but downloads cover
+        # the whole day, so they would all be scored with the same mosaic
+        if image_date in seen_dates:
+            continue
+        seen_dates.add(image_date)
+        interval_index = bisect.bisect_left(interval_ends, image_date)
+        if interval_index < len(time_series_intervals) and time_series_intervals[interval_index][0] <= image_date:
+            images_by_interval[interval_index].append(image_meta)
+    return images_by_interval
+
+
+def _write_ndvi_png(ndvi_array, png_path):
+    """Colors the int16 NDVI map `ndvi_array` with the NDVI palette and writes it as an RGBA PNG."""
+    # Color each pixel from the palette (binned like matplotlib, in integer arithmetic on the
+    # scaled values) and make "no data" transparent
+    palette_index = (ndvi_array.astype(np.int32) - _NDVI_VMIN_SCALED) * 256 // (_NDVI_VMAX_SCALED - _NDVI_VMIN_SCALED)
+    np.clip(palette_index, 0, 255, out=palette_index)
+    rgba = _ndvi_palette()[palette_index.astype(np.uint8)]
+    del palette_index
+    rgba[ndvi_array == NDVI_NODATA, 3] = 0
+    # Concurrent jobs may write the same map; each writes its own file and the last rename wins
+    with atomic_output_path(png_path) as tmp_path:
+        Image.fromarray(rgba, 'RGBA').save(tmp_path, format='PNG', **PNG_SAVE_OPTIONS)
+
+
+def _process_one_interval(ts_start_str, ts_end_str, results, bbox, size, max_cloud_coverage_in_polygon):
+    """
+    Finds the least cloudy of the images `results` found for one time interval and renders its NDVI map.
+    Returns (graph_entry, layer_entry), where layer_entry is None if the map has no valid pixels,
+    or None if the interval has no suitable image.
+    """
+    log.info("Scoring %d images for the interval: %s to %s", len(results), ts_start_str, ts_end_str)
+    if not results:
+        log.warning("No images found for the interval %s - %s. Skipping.", ts_start_str, ts_end_str)
+        return None
+
+    # Iterate through all found images and calculate their cloud coverage within our polygon, starting
+    # with those whose whole tile the catalog reports as least cloudy (unknown cover goes last)
+    image_cloud_scores = []
+    candidates = sorted(results, key=lambda meta: (
+        meta['properties'].get('eo:cloud_cover') is None, meta['properties'].get('eo:cloud_cover') or 0.0
+    ))
+    for image_meta in candidates:
+        image_date = image_meta['properties']['datetime'][:10]
+
+        # Download only the classification layer for the specific date
+        cloud_mask_stack = _fetch_band_stack(_EVALSCRIPT_CLOUD_MASK, "cloud_mask", bbox, size, image_date)
+        # A single-band TIFF may decode with or without a trailing band axis
+        scl_band = cloud_mask_stack.reshape(cloud_mask_stack.shape[:2])
+
+        # Calculate cloud percentage ONLY in valid pixels of the polygon
+        valid_pixels_mask = (scl_band != 0)
+        total_valid_pixels = np.count_nonzero(valid_pixels_mask)
+
+        if total_valid_pixels == 0:
+            cloud_coverage_in_polygon = 1.0 # 100% clouds if no data is available
+        else:
+            # Masking the flags with & instead of compressing the band with scl_band[valid_pixels_mask]
+            # avoids copying every valid pixel into a new array first
+            cloudy_pixels = _IS_CLOUD_SCL[scl_band] & valid_pixels_mask
+            cloud_coverage_in_polygon = np.count_nonzero(cloudy_pixels) / total_valid_pixels
+
+        log.info("  - Image from %s: Cloud coverage in polygon = %.2f%%", image_date, cloud_coverage_in_polygon * 100)
+        image_cloud_scores.append({
+            "date": image_date,
+            "coverage": cloud_coverage_in_polygon
+        })
+        # Release this candidate's arrays before the next download instead of at rebinding
+        del cloud_mask_stack, scl_band, valid_pixels_mask
+        # No later candidate can beat a cloud-free polygon, so their masks need not be downloaded
+        if cloud_coverage_in_polygon == 0.0:
+            break
+
+    # Select the best image (least clouds) in one pass, without building a filtered list first
+    best_image = min(
+        (img for img in image_cloud_scores if img['coverage'] <= max_cloud_coverage_in_polygon),
+        key=lambda x: x['coverage'], default=None
+    )
+    if best_image is None:
+        log.warning("No images with acceptable cloud coverage (<%.0f%%) found in interval. Skipping.", max_cloud_coverage_in_polygon * 100)
+        return None
+
+    image_date = best_image['date']
+    log.info("--> Best image for interval found: %s with %.2f%% cloud coverage in polygon.", image_date, best_image['coverage'] * 100)
+
+    # Now we download the NDVI map of the best image only, computed by Sentinel Hub
+    ndvi_stack = _fetch_band_stack(_EVALSCRIPT_NDVI, "ndvi", bbox, size, image_date)
+    # A single-band TIFF may decode with or without a trailing band axis
+    ndvi_array = ndvi_stack.reshape(ndvi_stack.shape[:2])
+    del ndvi_stack
+
+    ndvi_sum, valid_pixel_count = _ndvi_sum_and_count(ndvi_array)
+    mean_ndvi = ndvi_sum / valid_pixel_count / NDVI_SCALE if valid_pixel_count > 0 else np.nan
+    graph_entry = {'date': image_date, 'value': round(mean_ndvi, 4) if not np.isnan(mean_ndvi) else None}
+
+    layer_entry = None
+    if not np.isnan(mean_ndvi):
+        # The file is named after its content (the NDVI map and the palette), so repeated queries map to
+        # the same file and skip encoding, and a served URL never changes content
+        map_digest = hashlib.blake2b(digest_size=16)
+        map_digest.update(repr(ndvi_array.shape).encode('ascii'))
+        map_digest.update(ndvi_array.data)
+        map_digest.update(_ndvi_palette().data)
+        png_filename = f"ndvi_map_{image_date}_{map_digest.hexdigest()}.png"
+        png_path = os.path.join(OUTPUT_FOLDER, png_filename)
+        if not os.path.exists(png_path):
+            _write_ndvi_png(ndvi_array, png_path)
+        layer_entry = {
+            "date": image_date, 
+            "url": f"/output/{png_filename}", 
+            "bounds": [[bbox.min_y, bbox.min_x], [bbox.max_y, bbox.max_x]], 
+            "mean_ndvi": round(mean_ndvi, 4)
+        }
+    return graph_entry, layer_entry
 
 # ----- MAIN PROCESSING FUNCTION -----
 # Replace the original process_ndvi function entirely
@@ -103,214 +646,86 @@ def process_ndvi(
     image based on CLOUD COVERAGE WITHIN THE POLYGON, generates a PNG image of the NDVI map, 
     and returns structured data.
     """
-    # NEW EVALSCRIPT: Fetches B04(RED), B08(NIR), and importantly, SCL (Scene Classification Layer)
-    evalscript_all_data = """
-        //VERSION=3
-        function setup() {
-            return {
-                input: [{ bands: ["B04", "B08", "SCL", "dataMask"] }],
-                output: [
-                    { id: "B04", bands: 1, sampleType: SampleType.FLOAT32 },
-                    { id: "B08", bands: 1, sampleType: SampleType.FLOAT32 },
-                    { id: "SCL", bands: 1, sampleType: SampleType.UINT8 },
-                    { id: "dataMask", bands: 1, sampleType: SampleType.UINT8 }
-                ]
-            };
-        }
-        function evaluatePixel(samples) {
-            if (!samples.dataMask) {
-                return { B04: [NaN], B08: [NaN], SCL: [0], dataMask: [0] };
-            }
-            return { 
-                B04: [samples.B04], 
-                B08: [samples.B08], 
-                SCL: [samples.SCL], 
-                dataMask: [samples.dataMask] 
-            };
-        }
-    """
-
-    # In the SCL band, cloud and shadow values are 3 (shadow), 8 (med-prob cloud), 9 (high-prob cloud), 10 (thin cirrus)
-    CLOUD_SCL_VALUES = [3, 8, 9, 10] 
-
-    logging.info(f"Starting NDVI processing for polygon, from {start_date_str} to {end_date_str}, frequency: {frequency}")
+    log.info("Starting NDVI processing for polygon, from %s to %s, frequency: %s", start_date_str, end_date_str, frequency)
     
     # --- The rest of the function up to the loop remains the same (validation, bbox prep, etc.) ---
     area = calculate_polygon_area_sqkm(polygon_coords)
     if area > max_polygon_area_sqkm:
         raise ValueError(f"Polygon area ({area:.2f} km²) exceeds the maximum allowed size ({max_polygon_area_sqkm} km²).")
     
-    start_date_dt = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-    end_date_dt = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+    start_date_dt = date.fromisoformat(start_date_str)
+    end_date_dt = date.fromisoformat(end_date_str)
     
-    if (end_date_dt - start_date_dt).days > 365:
-        raise ValueError("The maximum duration of the time series is limited to 365 days (1 year).")
+    if (end_date_dt - start_date_dt).days > MAX_TIME_SERIES_DAYS:
+        raise ValueError(f"The maximum duration of the time series is limited to {MAX_TIME_SERIES_DAYS} days (1 year).")
 
     time_series_intervals = []
     if frequency == 'weekly':
         current_date = start_date_dt
         while current_date <= end_date_dt:
             interval_end = current_date + timedelta(days=6)
-            time_series_intervals.append((current_date.strftime('%Y-%m-%d'), interval_end.strftime('%Y-%m-%d')))
+            time_series_intervals.append((current_date.isoformat(), interval_end.isoformat()))
             current_date += timedelta(days=7)
     elif frequency == 'monthly':
         current_date = start_date_dt
         while current_date <= end_date_dt:
-            next_month = current_date.replace(day=28) + timedelta(days=4)
-            interval_end = next_month - timedelta(days=next_month.day)
-            time_series_intervals.append((current_date.strftime('%Y-%m-%d'), min(interval_end, end_date_dt).strftime('%Y-%m-%d')))
-            current_date = min(interval_end, end_date_dt) + timedelta(days=1)
+            # day=31 clamps to the last day of the current month
+            interval_end = min(current_date + relativedelta(day=31), end_date_dt)
+            time_series_intervals.append((current_date.isoformat(), interval_end.isoformat()))
+            current_date = interval_end + timedelta(days=1)
     
-    min_lon, max_lon = min(p[0] for p in polygon_coords), max(p[0] for p in polygon_coords)
-    min_lat, max_lat = min(p[1] for p in polygon_coords), max(p[1] for p in polygon_coords)
+    # One vectorized pass per axis instead of four Python generator scans over the vertices
+    coords = np.asarray(polygon_coords, dtype=np.float64)
+    min_lon, min_lat = coords.min(axis=0)
+    max_lon, max_lat = coords.max(axis=0)
     bbox = BBox(bbox=[min_lon, min_lat, max_lon, max_lat], crs=CRS.WGS84)
-    size = bbox_to_dimensions(bbox, resolution=10)
-
-    output_folder_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
-    if not os.path.exists(output_folder_path):
-        os.makedirs(output_folder_path)
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    size = bbox_to_dimensions(bbox, resolution=NATIVE_RESOLUTION_M)
+    # Long, thin polygons can span a bbox far larger than their area; request such scenes at a coarser
+    # resolution instead of downloading pixels the map overlay cannot show
+    if max(size) > MAX_IMAGE_DIMENSION_PX:
+        min_resolution = NATIVE_RESOLUTION_M * max(size) / MAX_IMAGE_DIMENSION_PX
+        resolution = next(
+            (tier for tier in RESOLUTION_TIERS_M if tier >= min_resolution),
+            RESOLUTION_TIERS_M[-1] * math.ceil(min_resolution / RESOLUTION_TIERS_M[-1])
+        )
+        size = bbox_to_dimensions(bbox, resolution=resolution)
+        log.info("Large bounding box, requesting imagery at %d m resolution (%dx%d px).", resolution, size[0], size[1])
 
     time_series_for_graph = []
     image_layers_for_map = []
-    cmap = plt.cm.RdYlGn
-    norm = plt.Normalize(vmin=-0.2, vmax=1.0)
-
-    # === THE MAIN LOGIC CHANGE IS HERE ===
-    for ts_start_str, ts_end_str in time_series_intervals:
-        logging.info(f"Searching for images for the interval: {ts_start_str} to {ts_end_str}")
-        # We search in L2A data, without a strict cloud filter
-        search_iterator = catalog.search(S2_L2A_CDSE_CUSTOM, bbox=bbox, time=(ts_start_str, ts_end_str), limit=max_images_to_consider)
-        results = list(search_iterator)
-        if not results:
-            logging.warning(f"No images found for the interval {ts_start_str} - {ts_end_str}. Skipping.")
-            continue
-        
-        # Iterate through all found images and calculate their cloud coverage within our polygon
-        image_cloud_scores = []
-        for image_meta in results:
-            image_date = image_meta['properties']['datetime'][:10]
-            
-            # Download data for the specific date
-            request = SentinelHubRequest(
-                evalscript=evalscript_all_data,
-                input_data=[SentinelHubRequest.input_data(
-                    data_collection=S2_L2A_CDSE_CUSTOM,
-                    time_interval=(image_date, image_date)
-                )],
-                responses=[
-                    SentinelHubRequest.output_response("B04", MimeType.TIFF),
-                    SentinelHubRequest.output_response("B08", MimeType.TIFF),
-                    SentinelHubRequest.output_response("SCL", MimeType.TIFF),
-                    SentinelHubRequest.output_response("dataMask", MimeType.TIFF)
-                ],
-                bbox=bbox, size=size, config=_GLOBAL_CDSE_CONFIG
-            )
-            downloaded_data = request.get_data(save_data=False)[0] # save_data=False saves disk space
-            
-            scl_band = downloaded_data['SCL.tif']
-            data_mask = downloaded_data['dataMask.tif']
 
-            # Calculate cloud percentage ONLY in valid pixels of the polygon
-            valid_pixels_mask = (data_mask == 1)
-            total_valid_pixels = np.count_nonzero(valid_pixels_mask)
+    # A single catalog round trip for the whole time series instead of one per interval
+    images_by_interval = _search_images_by_interval(bbox, time_series_intervals, max_images_to_consider)
 
-            if total_valid_pixels == 0:
-                cloud_coverage_in_polygon = 1.0 # 100% clouds if no data is available
-            else:
-                cloudy_pixels = np.isin(scl_band[valid_pixels_mask], CLOUD_SCL_VALUES)
-                cloud_coverage_in_polygon = np.count_nonzero(cloudy_pixels) / total_valid_pixels
-            
-            logging.info(f"  - Image from {image_date}: Cloud coverage in polygon = {cloud_coverage_in_polygon:.2%}")
-            # We store the data so we don't have to download it again
-            image_cloud_scores.append({
-                "date": image_date,
-                "coverage": cloud_coverage_in_polygon,
-                "data": downloaded_data
-            })
-
-        # Select the best image (least clouds)
-        valid_images = [img for img in image_cloud_scores if img['coverage'] <= max_cloud_coverage_in_polygon]
-        if not valid_images:
-            logging.warning(f"No images with acceptable cloud coverage (<{max_cloud_coverage_in_polygon:.0%}) found in interval. Skipping.")
+    # Intervals are independent and dominated by network latency, so they are processed in parallel
+    # Never start more threads than there are intervals
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_INTERVAL_WORKERS, len(time_series_intervals)))) as executor:
+        interval_results = list(executor.map(
+            lambda interval, results: _process_one_interval(
+                interval[0], interval[1], results, bbox, size, max_cloud_coverage_in_polygon
+            ),
+            time_series_intervals, images_by_interval
+        ))
+
+    for interval_result in interval_results:
+        if interval_result is None:
             continue
-            
-        best_image = sorted(valid_images, key=lambda x: x['coverage'])[0]
-        image_date = best_image['date']
-        logging.info(f"--> Best image for interval found: {image_date} with {best_image['coverage']:.2%} cloud coverage in polygon.")
-        
-        # Now we process the data from the best image
-        red_band, nir_band = best_image['data']['B04.tif'], best_image['data']['B08.tif']
-        data_mask = best_image['data']['dataMask.tif']
-
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ndvi_array = (nir_band.astype(float) - red_band.astype(float)) / (nir_band.astype(float) + red_band.astype(float))
-        
-        ndvi_array = np.clip(ndvi_array, -1.0, 1.0)
-        ndvi_array[np.isnan(ndvi_array)] = -999 # Value for "no data"
-        
-        valid_ndvi_pixels = ndvi_array[data_mask == 1]
-        mean_ndvi = np.mean(valid_ndvi_pixels) if valid_ndvi_pixels.size > 0 else np.nan
-        time_series_for_graph.append({'date': image_date, 'value': round(mean_ndvi, 4) if not np.isnan(mean_ndvi) else None})
-        
-        if not np.isnan(mean_ndvi):
-            fig, ax = plt.subplots(figsize=(6, 6), dpi=150)
-            ax.set_axis_off()
-            masked_ndvi = np.ma.masked_where(ndvi_array == -999, ndvi_array)
-            ax.imshow(masked_ndvi, cmap=cmap, norm=norm)
-            png_filename = f"ndvi_map_{image_date}_{timestamp}.png"
-            png_path = os.path.join(output_folder_path, png_filename)
-            plt.savefig(png_path, format='png', bbox_inches='tight', pad_inches=0, transparent=True)
-            plt.close(fig)
-            image_layers_for_map.append({
-                "date": image_date, 
-                "url": f"/output/{png_filename}", 
-                "bounds": [[bbox.min_y, bbox.min_x], [bbox.max_y, bbox.max_x]], 
-                "mean_ndvi": round(mean_ndvi, 4)
-            })
+        graph_entry, layer_entry = interval_result
+        time_series_for_graph.append(graph_entry)
+        if layer_entry is not None:
+            image_layers_for_map.append(layer_entry)
 
     # --- The rest of the function (graph/legend generation, return value) remains the same ---
     if not image_layers_for_map:
-        logging.warning("Processing finished, but no map layers were generated.")
+        log.warning("Processing finished, but no map layers were generated.")
         return None
 
-    graph_path = None
-    try:
-        plot_data = [item for item in time_series_for_graph if item.get('value') is not None]
-        if plot_data:
-            dates = [datetime.strptime(item['date'], '%Y-%m-%d') for item in plot_data]
-            values = [item['value'] for item in plot_data]
-            fig_graph, ax_graph = plt.subplots(figsize=(10, 5), dpi=100)
-            ax_graph.plot(dates, values, marker='o', linestyle='-', color='green')
-            ax_graph.set_title("NDVI Time Series", fontsize=16)
-            ax_graph.set_ylabel("Average NDVI")
-            ax_graph.grid(True, linestyle='--', alpha=0.6)
-            ax_graph.tick_params(axis='x', rotation=45)
-            fig_graph.tight_layout()
-            graph_filename = f"graph_{timestamp}.png"
-            graph_path = os.path.join(output_folder_path, graph_filename)
-            fig_graph.savefig(graph_path, format='png')
-            plt.close(fig_graph)
-    except Exception as e:
-        logging.error(f"Failed to generate graph image: {e}")
-
-    legend_path = None
-    try:
-        fig_legend, ax_legend = plt.subplots(figsize=(5, 0.8), dpi=100)
-        cbar = matplotlib.colorbar.ColorbarBase(ax_legend, cmap=cmap, norm=norm, orientation='horizontal')
-        ax_legend.set_title("NDVI Value")
-        fig_legend.tight_layout()
-        legend_filename = f"legend_{timestamp}.png"
-        legend_path = os.path.join(output_folder_path, legend_filename)
-        fig_legend.savefig(legend_path, format='png', transparent=True)
-        plt.close(fig_legend)
-    except Exception as e:
-        logging.error(f"Failed to generate legend image: {e}")
+    legend_path = _static_legend_path()
 
+    # Intervals are built and collected in chronological order, so no sorting is needed
     return {
-        "graphData": sorted(time_series_for_graph, key=lambda x: x['date']),
-        "imageLayers": sorted(image_layers_for_map, key=lambda x: x['date']),
-        "graphPngPath": graph_path,
+        "graphData": time_series_for_graph,
+        "imageLayers": image_layers_for_map,
         "legendPngPath": legend_path
     }
 
@@ -320,14 +735,14 @@ if __name__ == '__main__':
     test_polygon = [ [18.435, 49.792], [18.435, 49.801], [18.448, 49.801], [18.448, 49.792], [18.435, 49.792] ]
     print("Starting a test run of `process_ndvi`...")
     try:
-        end_date = date.today().strftime('%Y-%m-%d')
-        start_date = (date.today() - timedelta(days=90)).strftime('%Y-%m-%d')
+        end_date = date.today().isoformat()
+        start_date = (date.today() - timedelta(days=90)).isoformat()
         result_data = process_ndvi(test_polygon, start_date, end_date, 'monthly')
         if result_data:
             print("\n✅ Processing was successful!")
-            print(f"Graph image path: {result_data.get('graphPngPath')}")
+            print(f"Graph image path: {render_graph_png(result_data['graphData'])}")
             print(f"Legend image path: {result_data.get('legendPngPath')}")
         else:
             print("\n❌ Processing failed or returned no data.")
     except Exception as e:
-        logging.exception("An unexpected error occurred during the test run.")
\ No newline at end of file
+        log.exception("An unexpected error occurred during the test run.")
\ No newline at end of file
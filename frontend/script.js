@@ -56,6 +56,9 @@ document.addEventListener('DOMContentLoaded', () => {
     const downloadLinkContainer = document.getElementById('downloadLinkContainer');
     const opacitySlider = document.getElementById('opacitySlider');
     const opacityValueLabel = document.getElementById('opacityValueLabel');
+    const JOB_POLL_INTERVAL_MS = 2000;
+    // Give up on a job after this long instead of polling until the server times it out
+    const JOB_POLL_TIMEOUT_MS = 10 * 60 * 1000;
 
     function updateStatus(message, type = '') {
         statusMessage.textContent = message;
@@ -133,6 +136,26 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    // Polls a background NDVI job until it finishes, fails or JOB_POLL_TIMEOUT_MS runs out
+    async function pollJob(jobId) {
+        const deadline = Date.now() + JOB_POLL_TIMEOUT_MS;
+        while (Date.now() < deadline) {
+            await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+            const response = await fetch(`/status/${jobId}`);
+            const status = await response.json();
+            if (!response.ok) {
+                return { ok: false, result: status };
+            }
+            if (status.status === 'finished' && status.result) {
+                return { ok: true, result: status.result };
+            }
+            if (status.status !== 'queued' && status.status !== 'running') {
+                return { ok: false, result: status };
+            }
+        }
+        return { ok: false, result: { error: 'NDVI processing is taking too long. Please try again later.' } };
+    }
+
     // === KEY FUNCTION: Listener for the "Process NDVI" button ===
     processBtn.addEventListener('click', async () => {
         if (!currentPolygon) {
@@ -156,6 +179,7 @@ document.addEventListener('DOMContentLoaded', () => {
         
         const geoJson = currentPolygon.toGeoJSON();
         const polygonCoords = geoJson.geometry.coordinates[0].map(coord => [coord[0], coord[1]]);
+        const frequency = frequencySelect.value;
 
         try {
             const response = await fetch('/process-ndvi', {
@@ -165,13 +189,19 @@ document.addEventListener('DOMContentLoaded', () => {
                     polygon: polygonCoords,
                     startDate: startDate,
                     endDate: endDate,
-                    frequency: frequencySelect.value
+                    frequency: frequency
                 })
             });
 
-            const result = await response.json();
+            let result = await response.json();
+            let ok = response.ok;
 
-            if (response.ok) {
+            // Uncached requests are processed in the background; poll until the job is done
+            if (response.status === 202) {
+                ({ ok, result } = await pollJob(result.jobId));
+            }
+
+            if (ok) {
                 drawnItems.clearLayers();
                 updateStatus(`Processing complete! Found ${result.imageLayers.length} images.`, 'success');
                 
@@ -214,7 +244,8 @@ document.addEventListener('DOMContentLoaded', () => {
                     activeMapLayers.forEach(layer => map.removeLayer(layer));
                     const layerInfo = imageLayers[index];
                     if (layerInfo) {
-                        const layer = L.imageOverlay(layerInfo.url, layerInfo.bounds, { 
+                        // Inlined layers render without another round trip to /output
+                        const layer = L.imageOverlay(layerInfo.dataUrl || layerInfo.url, layerInfo.bounds, { 
                             opacity: opacitySlider.value 
                         });
                         layer.addTo(map);
@@ -239,15 +270,16 @@ document.addEventListener('DOMContentLoaded', () => {
                 exportBtn.id = 'exportBtn';
                 exportBtn.textContent = 'Export to HTML';
                 
+                // The report is served from the cached result, so it must use the parameters that were
+                // processed, not whatever the form holds by the time the button is clicked
+                const exportParams = new URLSearchParams({
+                    startDate: startDate,
+                    endDate: endDate,
+                    frequency: frequency,
+                    polygon: JSON.stringify(polygonCoords) 
+                });
                 exportBtn.onclick = () => {
-                    const params = new URLSearchParams({
-                        startDate: startDateInput.value,
-                        endDate: endDateInput.value,
-                        frequency: frequencySelect.value,
-                        polygon: JSON.stringify(polygonCoords) 
-                    });
-                    
-                    const exportUrl = `/export-html?${params.toString()}`;
+                    const exportUrl = `/export-html?${exportParams.toString()}`;
                     window.open(exportUrl, '_blank');
                 };
                 downloadLinkContainer.appendChild(exportBtn);
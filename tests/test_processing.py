@@ -0,0 +1,21 @@
+import os
+import unittest
+
+os.environ.setdefault('CDSE_CLIENT_ID', 'test-client-id')
+os.environ.setdefault('CDSE_CLIENT_SECRET', 'test-client-secret')
+
+from sentinelhub import SentinelHubCatalog
+
+from backend import processing
+
+
+class PooledCatalogClientTest(unittest.TestCase):
+    def test_retry_time_matches_stock_client(self):
+        stock_catalog = SentinelHubCatalog(config=processing._GLOBAL_CDSE_CONFIG)
+        pooled_client = processing._get_catalog().client
+        self.assertIsInstance(pooled_client, processing._PooledDownloadClient)
+        self.assertEqual(pooled_client.default_retry_time, stock_catalog.client.default_retry_time)
+
+
+if __name__ == '__main__':
+    unittest.main()